@@ -8,7 +8,12 @@ import optparse
 import sys
 import os
 
+import sms_export
+import sms_pipeline
+import sms_recovery
+import sms_stats
 import sms_to_chat
+import sms_users
 
 
 def ParseArgs(args):
@@ -36,22 +41,115 @@ def ParseArgs(args):
       dest='log', default='WARNING',
       help='Logging level to use (DEBUG, INFO, WARNING, ERROR, CRITICAL) '
            'Default: WARNING')
-  return parser.parse_args(args)[0]
+  parser.add_option('-x', '--exporter', action='store', type='choice',
+      dest='exporter', choices=sorted(sms_to_chat.EXPORTERS), default='adium',
+      help='Log exporter to use (%s). adium writes one XML log per thread, '
+           'jsonl writes one JSON Lines log per interaction. '
+           'Default: adium' % ', '.join(sorted(sms_to_chat.EXPORTERS)))
+  parser.add_option('-f', '--format', action='store', type='choice',
+      dest='format', choices=list(sms_export.FORMATS), default='xml',
+      help='Output format for chat logs (%s). xml writes each log as is, '
+           'gzip compresses each log, tar and tar.gz write all logs to a '
+           'single logs.tar archive, stream (jsonl only) appends all logs '
+           'to messages.jsonl. Default: xml' % ', '.join(sms_export.FORMATS))
+  parser.add_option('-r', '--region', action='store', type='string',
+      dest='region', default='US',
+      help='Region to parse phone numbers without a country code in. '
+           'Default: US')
+  parser.add_option('-w', '--workers', action='store', type='int',
+      dest='workers', default=None,
+      help='Number of processes used to render chat logs. '
+           'Default: one per CPU')
+  parser.add_option('--readers', action='store', type='int',
+      dest='readers', default=2,
+      help='Number of threads reading email files. Default: 2')
+  parser.add_option('--parsers', action='store', type='int',
+      dest='parsers', default=1,
+      help='Number of threads parsing emails. Default: 1')
+  parser.add_option('-q', '--queue-size', action='store', type='int',
+      dest='queue_size', default=64,
+      help='Maximum number of items waiting between pipeline stages. '
+           'Default: 64')
+  parser.add_option('-k', '--keep-going', action='store_true',
+      dest='keep_going', default=False,
+      help='Quarantine messages which fail to convert, listing them in '
+           'quarantine.json in the export directory, instead of aborting.')
+  parser.add_option('-c', '--checkpoint', action='store_true',
+      dest='checkpoint', default=False,
+      help='Checkpoint each stage in the export directory, so an '
+           'interrupted run resumes where it stopped. Checkpoints are not '
+           'used once emails are added to or removed from the maildir.')
+  parser.add_option('-s', '--stats', action='store', type='choice',
+      dest='stats', choices=['json', 'csv'], default=None,
+      help='Only count messages per contact, thread and month from email '
+           'headers, writing stats.<json|csv> to the export directory. '
+           'No chat logs are generated.')
+  options = parser.parse_args(args)[0]
+  try:
+    sms_users.SetRegion(options.region)
+  except sms_users.Error, e:
+    parser.error(e)
+  if options.format == 'stream' and options.exporter != 'jsonl':
+    parser.error('--format=stream requires --exporter=jsonl')
+  for name in ('workers', 'readers', 'parsers', 'queue_size'):
+    value = getattr(options, name)
+    if value is not None and value < 1:
+      parser.error('--%s must be at least 1' % name.replace('_', '-'))
+  return options
 
 
 def main(args):
   options = ParseArgs(args)
   logging.basicConfig(level=getattr(logging, options.log.upper(), None))
-  sms_chat = sms_to_chat.SmsToChat(options.maildir, options.timezone)
-  logs = sms_chat.Process()
-  print 'Writing logs ',
-  count = len(logs)
-  for filename, logdata in logs:
-    print '.',
-    location = os.path.join(options.export, filename)
+  quarantine = None
+  if options.keep_going:
+    quarantine = sms_recovery.Quarantine(
+        os.path.join(options.export, 'quarantine.json'))
+  if options.stats:
+    stats = sms_stats.LoadStats(
+        options.maildir, options.timezone, quarantine=quarantine,
+        readers=options.readers, parsers=options.parsers,
+        queue_size=options.queue_size)
+    location = os.path.join(options.export, 'stats.%s' % options.stats)
     file_pointer = open(location, 'w')
-    file_pointer.write(logdata)
+    if options.stats == 'json':
+      stats.WriteJson(file_pointer)
+    else:
+      stats.WriteCsv(file_pointer)
     file_pointer.close()
+    print 'Counted %s messages.' % stats.total
+    if quarantine:
+      quarantine.Write()
+      print 'Quarantined %s messages.' % len(quarantine.entries)
+    return
+  checkpoint = None
+  if options.checkpoint:
+    checkpoint = sms_recovery.Checkpoint(options.export, (
+        os.path.abspath(options.maildir), options.timezone, options.region,
+        options.keep_going, options.exporter,
+        sms_recovery.MaildirSignature(options.maildir)))
+  sms_chat = sms_to_chat.SmsToChat(
+      options.maildir, options.timezone, options.workers, quarantine,
+      checkpoint, options.readers, options.parsers, options.queue_size,
+      options.exporter)
+  writer = sms_export.NewLogWriter(options.export, options.format)
+
+  def Write(log):
+    filename, logdata = log
+    writer.Write(filename, logdata)
+    print '.',
+    if checkpoint and (writer.written + writer.unchanged) % 100 == 0:
+      writer.Save()
+
+  sms_pipeline.Drain(Write, sms_chat.IterLogs(), options.queue_size)
+  writer.Close()
+  print
+  print 'Wrote %s logs, %s unchanged.' % (writer.written, writer.unchanged)
+  if quarantine:
+    quarantine.Write()
+    print 'Quarantined %s messages.' % len(quarantine.entries)
+  if checkpoint:
+    checkpoint.Clear()
 
 
 if __name__ == '__main__':
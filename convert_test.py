@@ -0,0 +1,132 @@
+#!/usr/bin/python
+#
+# Startup regression checks for convert.py.
+#
+# Heavy dependencies must stay out of module import so --help and small
+# incremental runs start quickly.
+#
+
+import base64
+import json
+import mailbox
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import sms_recovery
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+_CONVERT = os.path.join(_DIRECTORY, 'convert.py')
+
+# Modules which must only be imported on first use.
+_LAZY_MODULES = ('phonenumbers', 'pytz', 'mailbox', 'uuid', 'multiprocessing',
+                 'tarfile', 'gzip')
+
+# Upper bound for convert.py --help, in seconds. Around 0.1s locally.
+_HELP_SECONDS = 0.5
+
+
+def _Run(args):
+  """ Runs python with args from the repository, returning (code, out, err). """
+  process = subprocess.Popen(
+      [sys.executable] + args, cwd=_DIRECTORY,
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = process.communicate()
+  return (process.returncode, out, err)
+
+
+def _AddSms(maildir, sms_id, body):
+  """ Adds an SMS Backup+ email received from 2125550000 to a maildir. """
+  email = mailbox.MaildirMessage()
+  email['From'] = '2125550000@unknown.person'
+  email['To'] = 'Me <me@example.com>'
+  email['Subject'] = 'SMS with 2125550000'
+  email['Date'] = 'Tue, 13 May 2014 10:29:20 -0700'
+  email['X-smssync-id'] = str(sms_id)
+  email['X-smssync-address'] = '2125550000'
+  email['X-smssync-type'] = '1'
+  email['X-smssync-date'] = str(1400000000000 + sms_id * 60000)
+  email['X-smssync-thread'] = '1'
+  email.set_payload(base64.b64encode(body))
+  return maildir.add(email)
+
+
+class StartupTest(unittest.TestCase):
+
+  def testImportIsLazy(self):
+    code, out, err = _Run(['-c',
+        'import sys, convert\n'
+        'print " ".join(m for m in %r if m in sys.modules)' %
+        (_LAZY_MODULES,)])
+    self.assertEqual(0, code, err)
+    self.assertEqual('', out.strip())
+
+  def testHelpStartupTime(self):
+    timings = []
+    for _ in range(3):
+      start = time.time()
+      code, _, err = _Run([_CONVERT, '--help'])
+      timings.append(time.time() - start)
+      self.assertEqual(0, code, err)
+    print >> sys.stderr, 'convert.py --help: %.3fs' % min(timings)
+    self.assertLess(min(timings), _HELP_SECONDS)
+
+  def testUnsupportedRegion(self):
+    code, _, err = _Run([_CONVERT, '--region', 'zz', '--help'])
+    self.assertEqual(0, code, err)
+    code, _, err = _Run([_CONVERT, '--region', 'zz', '-m', '.'])
+    self.assertEqual(2, code)
+    self.assertIn('Unsupported phone number region: ZZ', err)
+    self.assertNotIn('Traceback', err)
+
+  def testCountsBelowOne(self):
+    for option in ('--workers', '--readers', '--parsers', '--queue-size'):
+      code, _, err = _Run([_CONVERT, '-m', '.', option, '0'])
+      self.assertEqual(2, code, option)
+      self.assertIn('%s must be at least 1' % option, err)
+
+
+class ConvertTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.export = os.path.join(self.directory, 'export')
+    os.mkdir(self.export)
+    self.location = os.path.join(self.directory, 'maildir')
+    self.maildir = mailbox.Maildir(self.location, create=True)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _Convert(self, *args):
+    return _Run([_CONVERT, '-m', self.location, '-e', self.export] +
+                list(args))
+
+  def testKeepGoingQuarantinesInvalidBody(self):
+    _AddSms(self.maildir, 1, 'hello')
+    bad = _AddSms(self.maildir, 2, 'caf\xe9')
+    code, out, err = self._Convert('-k')
+    self.assertEqual(0, code, err)
+    self.assertIn('Wrote 1 logs', out)
+    file_pointer = open(os.path.join(self.export, 'quarantine.json'))
+    entries = json.load(file_pointer)
+    file_pointer.close()
+    self.assertEqual([(bad, 'load')], [(e['key'], e['stage']) for e in entries])
+
+  def testMaildirSignature(self):
+    key = _AddSms(self.maildir, 1, 'hello')
+    signature = sms_recovery.MaildirSignature(self.location)
+    self.assertEqual(signature, sms_recovery.MaildirSignature(self.location))
+    _AddSms(self.maildir, 2, 'hello')
+    added = sms_recovery.MaildirSignature(self.location)
+    self.assertNotEqual(signature, added)
+    self.maildir.remove(key)
+    self.assertNotEqual(added, sms_recovery.MaildirSignature(self.location))
+
+
+if __name__ == '__main__':
+  unittest.main()
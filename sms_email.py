@@ -10,11 +10,10 @@
 
 import base64
 import datetime
+import hashlib
 import logging
-import mailbox
-import phonenumbers
-import pytz
 
+import sms_pipeline
 import sms_users
 
 
@@ -28,6 +27,50 @@ class InitError(Error):
   pass
 
 
+class DuplicateFilter(object):
+  """ Detects duplicate SMS emails before they are parsed.
+
+  SMS Backup+ re-syncs and label moves leave multiple copies of the same SMS
+  email in a maildir. Each email is fingerprinted from the SMS headers that
+  identify it, or from the raw headers if those are missing, and the 20 byte
+  SHA1 digest of each fingerprint seen is kept.
+
+  Attributes:
+    skipped: Integer number of duplicate emails detected.
+  """
+  _FINGERPRINT_HEADERS = ('x-smssync-id', 'x-smssync-thread',
+                          'x-smssync-date', 'x-smssync-address')
+
+  def __init__(self):
+    self._digests = set()
+    self.skipped = 0
+
+  def _Fingerprint(self, email):
+    """ Returns a String SHA1 digest identifying the SMS in an email.
+
+    Args:
+      email: mailbox.MaildirMessage SMS email to fingerprint.
+    """
+    values = [email.get(header) for header in self._FINGERPRINT_HEADERS]
+    if None in values:
+      return hashlib.sha1(''.join(email.headers)).digest()
+    return hashlib.sha1(
+        '\0'.join([value.strip() for value in values])).digest()
+
+  def IsDuplicate(self, email):
+    """ Returns True if an identical SMS email has already been seen.
+
+    Args:
+      email: mailbox.MaildirMessage SMS email to check.
+    """
+    digest = self._Fingerprint(email)
+    if digest in self._digests:
+      self.skipped += 1
+      return True
+    self._digests.add(digest)
+    return False
+
+
 class LineToken(object):
   """ Process a given email line into given parsable tokens.
 
@@ -36,12 +79,22 @@ class LineToken(object):
     email: String email in the line.
     phone: phonenumbers.phonenumber.PhoneNumber of phone number in the line.
   """
+  # Parsed header values by (phone region, header value); the same few
+  # addresses repeat across most emails.
+  _CACHE = {}
+  _CACHE_LIMIT = 10000
 
   def __init__(self, data):
     self.phone = None
     self.name = None
     self.email = None
-    self.phone, self.name, self.email = self._ParsePhoneNameEmail(data)
+    cache_key = (sms_users.GetRegion(), data)
+    parsed = self._CACHE.get(cache_key)
+    if parsed is None:
+      parsed = self._ParsePhoneNameEmail(data)
+      if len(self._CACHE) < self._CACHE_LIMIT:
+        self._CACHE[cache_key] = parsed
+    self.phone, self.name, self.email = parsed
 
   def _ParsePhoneNameEmail(self, raw_data):
     """ Parses data for a phone number, real name or email address.
@@ -62,8 +115,10 @@ class LineToken(object):
     if 'SMS with ' in raw_data:
       data = data.split('SMS with ')[1].strip()
 
+    if sms_users.IsPlainEmail(data):
+      return (None, None, data)
     try:
-      return (phonenumbers.parse(data, 'US'), None, None)
+      return (sms_users.ParsePhone(data), None, None)
     except:
       if "@" in data:
         if '<' in data and '>' in data:
@@ -106,18 +161,26 @@ class SmsMessage(object):
     message: String actual text message sent over SMS.
     tz: String timezone code for the message. Default 'Etc/UTC' (UTC).
     uuis: String interaction UUID for the message. Default None.
+    key: String maildir key of the email. Default None.
   """
 
-  def __init__(self, email, tz='Etc/UTC', uuid=None):
+  def __init__(self, email, tz='Etc/UTC', uuid=None, headers_only=False,
+               key=None):
     """ Creates a SmsMessage from a mailbox.MaildirMessage email.
     
     Args:
       email: mailbox.MaildirMessage SMS email to convert.
       tz: String timezone for messages. Default=Etc/UTC.
+      headers_only: Boolean True to skip decoding the message body and the
+          service center. message and service_center are set to None.
+          Default False.
+      key: String maildir key of the email. Default None.
 
     Raises:
       InitError: If there was an error creating the object on import.
     """
+    import pytz
+    self.key = key
     try:
       logging.info('SMS email date: %s', email['date'])
       self.to = LineToken(email['to'])
@@ -134,17 +197,26 @@ class SmsMessage(object):
       self.read = int(email.get('x-smssync-read', 1))
       self.status = int(email.get('x-smssync-status', -1))
       self.protocol = int(email.get('x-smssync-protocol', 0))
-      self.service_center = LineToken(email.get('x-smssync-service_center', ''))
       self.content_type = email.get('content-type')
-      self.message = base64.b64decode(email.fp.read()).strip()
-      if not self.message:
-        logging.warning('Empty SMS: %s; id: %s', self.date, self.id)
+      if headers_only:
+        self.service_center = None
+        self.message = None
+      else:
+        self.service_center = LineToken(
+            email.get('x-smssync-service_center', ''))
+        self.message = base64.b64decode(email.fp.read()).strip()
+        if not self.message:
+          logging.warning('Empty SMS: %s; id: %s', self.date, self.id)
+        try:
+          self.message.decode('utf8')
+        except UnicodeDecodeError, e:
+          raise InitError('INVALID SMS email, message is not UTF-8: %s' % e)
       self.tz = pytz.timezone(tz)
       self.uuid = None
     except KeyError, e:
       logging.critical('KeyError: %s', e)
       logging.critical('INVALID email: %s', email)
-      raise InitError('INVALID SMS email: %s', email)
+      raise InitError('INVALID SMS email, missing header: %s' % e)
 
   def GetSender(self):
     """ Determines the sender of the message, based on message attributes.
@@ -300,23 +372,93 @@ class SmsMessage(object):
     return sms_users.User(phone, name, email)
 
 
-def LoadMaildir(maildir, timezone):
+def IterMaildir(maildir, timezone, headers_only=False, quarantine=None,
+                readers=1, parsers=1, queue_size=64):
+  """ Yields SMS messages from maildir email as they are read.
+
+  Reading email files and parsing them run as separate stages connected by
+  bounded queues, so disk reads overlap with parsing. Messages are yielded in
+  maildir order for any number of readers or parsers.
+
+  Duplicate SMS emails are dropped before they are parsed.
+
+  Args:
+    maildir: String location of maildir folder to process.
+    timezone: String timezone to assume messages are received in.
+    headers_only: Boolean True to read and parse email headers only.
+        Default False.
+    quarantine: sms_recovery.Quarantine to record emails which fail to parse
+        and continue. Default None (errors are raised).
+    readers: Integer number of threads reading email files. Default 1.
+    parsers: Integer number of threads parsing emails. Default 1.
+    queue_size: Integer maximum number of emails queued between stages.
+        Default 64.
+
+  Yields:
+    SmsMessage objects from email messages.
+  """
+  import mailbox
+  import rfc822
+  import StringIO
+  mbox = mailbox.Maildir(maildir)
+  duplicates = DuplicateFilter()
+
+  def Read(key):
+    file_pointer = mbox.get_file(key)
+    try:
+      if headers_only:
+        return (key, rfc822.Message(file_pointer))
+      return (key, rfc822.Message(StringIO.StringIO(file_pointer.read())))
+    finally:
+      file_pointer.close()
+
+  def Unique(emails):
+    for key, email in emails:
+      if duplicates.IsDuplicate(email):
+        logging.info('Duplicate SMS email skipped: %s', email.get('date'))
+        continue
+      yield (key, email)
+
+  def Parse(key_email):
+    key, email = key_email
+    try:
+      return SmsMessage(email, timezone, headers_only=headers_only, key=key)
+    except Exception, e:
+      if quarantine is None:
+        raise
+      quarantine.Add(key, 'load', e)
+      return None
+
+  emails = sms_pipeline.Map(Read, mbox.iterkeys(), readers, queue_size)
+  for sms in sms_pipeline.Map(Parse, Unique(emails), parsers, queue_size):
+    if sms is not None:
+      yield sms
+  print 'Skipped %s duplicate messages.' % duplicates.skipped
+
+
+def LoadMaildir(maildir, timezone, quarantine=None, readers=1, parsers=1,
+                queue_size=64):
   """ Loads SMS messages from maildir email.
 
+  Duplicate SMS emails are dropped before they are parsed.
+
   Args:
     maildir: String location of maildir folder to process.
     timezone: String timezone to assume messages are received in.
+    quarantine: sms_recovery.Quarantine to record emails which fail to parse
+        and continue. Default None (errors are raised).
+    readers: Integer number of threads reading email files. Default 1.
+    parsers: Integer number of threads parsing emails. Default 1.
+    queue_size: Integer maximum number of emails queued between stages.
+        Default 64.
 
   Returns:
     List of SmsMessage objects from email messages.
   """
   print 'Loading messages ...'
-  mbox = mailbox.Maildir(maildir)
-  sms_messages = []
-  for email in mbox:
-    sms_messages.append(SmsMessage(email, timezone))
-  return sms_messages
-
+  return list(IterMaildir(maildir, timezone, quarantine=quarantine,
+                          readers=readers, parsers=parsers,
+                          queue_size=queue_size))
 
 if __name__ == '__main__':
   pass  
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+#
+# Writes generated chat logs to an export directory.
+#
+
+import hashlib
+import json
+import logging
+import os
+import StringIO
+import time
+
+FORMATS = ('xml', 'gzip', 'tar', 'tar.gz', 'stream')
+
+
+class LogWriter(object):
+  """ Writes chat logs to an export directory, skipping unchanged logs.
+
+  A manifest of SHA1 content digests per log filename is kept in the export
+  directory. Logs whose digest matches the manifest, and which still exist on
+  disk, are not rewritten so their mtimes are left untouched.
+
+  Attributes:
+    written: Integer number of logs written.
+    unchanged: Integer number of logs skipped as unchanged.
+  """
+  _MANIFEST = '.manifest.json'
+
+  def __init__(self, export):
+    """ Initialize LogWriter.
+
+    Args:
+      export: String directory to export chat logs to.
+    """
+    self._export = export
+    self._old_digests = self._LoadManifest()
+    self._digests = {}
+    self.written = 0
+    self.unchanged = 0
+
+  def _LoadManifest(self):
+    """ Returns the Dictionary {filename: digest} from the last run. """
+    location = os.path.join(self._export, self._MANIFEST)
+    if not os.path.exists(location):
+      return {}
+    try:
+      file_pointer = open(location, 'r')
+      try:
+        return json.load(file_pointer)
+      finally:
+        file_pointer.close()
+    except ValueError, e:
+      logging.warning('Ignoring unreadable manifest %s: %s', location, e)
+      return {}
+
+  def Write(self, filename, logdata):
+    """ Writes a chat log if its content changed since the last run.
+
+    Args:
+      filename: String log filename within the export directory.
+      logdata: String log content.
+
+    Returns:
+      Boolean True if the log was written.
+    """
+    if isinstance(logdata, unicode):
+      logdata = logdata.encode('utf8')
+    digest = hashlib.sha1(logdata).hexdigest()
+    self._digests[filename] = digest
+    location = self._Location(filename)
+    if self._old_digests.get(filename) == digest and os.path.exists(location):
+      self.unchanged += 1
+      return False
+    self._WriteLog(location, logdata)
+    self.written += 1
+    return True
+
+  def _Location(self, filename):
+    """ Returns the String path a log filename is written to. """
+    return os.path.join(self._export, filename)
+
+  def _WriteLog(self, location, logdata):
+    """ Writes log content to a path. """
+    file_pointer = open(location, 'w')
+    file_pointer.write(logdata)
+    file_pointer.close()
+
+  def Save(self):
+    """ Saves the manifest for logs written or checked so far this run. """
+    location = os.path.join(self._export, self._MANIFEST)
+    file_pointer = open(location + '.tmp', 'w')
+    json.dump(self._digests, file_pointer, indent=0, sort_keys=True)
+    file_pointer.close()
+    os.rename(location + '.tmp', location)
+
+  def Close(self):
+    """ Saves the manifest for logs written or checked in this run. """
+    self.Save()
+
+
+class GzipLogWriter(LogWriter):
+  """ Writes each chat log gzip compressed, as <filename>.gz.
+
+  The gzip header timestamp is fixed so unchanged logs compress identically.
+  """
+
+  def _Location(self, filename):
+    return os.path.join(self._export, '%s.gz' % filename)
+
+  def _WriteLog(self, location, logdata):
+    import gzip
+    file_pointer = gzip.GzipFile(location, 'wb', mtime=0)
+    file_pointer.write(logdata)
+    file_pointer.close()
+
+
+class TarLogWriter(object):
+  """ Streams all chat logs into a single tar archive.
+
+  Logs are added to the archive as they are written, keeping their log
+  filenames. The archive is rewritten on every run.
+
+  Attributes:
+    written: Integer number of logs written.
+    unchanged: Integer number of logs skipped as unchanged. Always 0.
+  """
+
+  def __init__(self, export, compress=False):
+    """ Initialize TarLogWriter.
+
+    Args:
+      export: String directory to write the logs.tar(.gz) archive to.
+      compress: Boolean True to gzip the archive. Default False.
+    """
+    import tarfile
+    self._tarfile = tarfile
+    if compress:
+      location = os.path.join(export, 'logs.tar.gz')
+      self._tar = self._tarfile.open(location, 'w|gz')
+    else:
+      location = os.path.join(export, 'logs.tar')
+      self._tar = self._tarfile.open(location, 'w|')
+    self._mtime = time.time()
+    self.written = 0
+    self.unchanged = 0
+
+  def Write(self, filename, logdata):
+    """ Adds a chat log to the archive.
+
+    Args:
+      filename: String log filename within the archive.
+      logdata: String log content.
+
+    Returns:
+      Boolean True, the log is always written.
+    """
+    if isinstance(logdata, unicode):
+      logdata = logdata.encode('utf8')
+    info = self._tarfile.TarInfo(filename)
+    info.size = len(logdata)
+    info.mtime = self._mtime
+    self._tar.addfile(info, StringIO.StringIO(logdata))
+    self.written += 1
+    return True
+
+  def Save(self):
+    """ Does nothing; a partially written archive cannot be resumed. """
+    pass
+
+  def Close(self):
+    """ Finishes the archive. """
+    self._tar.close()
+
+
+class StreamLogWriter(object):
+  """ Appends all logs to a single stream file, one log after another.
+
+  Only useful for line based logs (JSON Lines), where each log is a partition
+  of the stream. The stream is rewritten on every run.
+
+  Attributes:
+    written: Integer number of logs written.
+    unchanged: Integer number of logs skipped as unchanged. Always 0.
+  """
+
+  def __init__(self, export, filename='messages.jsonl'):
+    """ Initialize StreamLogWriter.
+
+    Args:
+      export: String directory to write the stream file to.
+      filename: String stream filename. Default 'messages.jsonl'.
+    """
+    self._file_pointer = open(os.path.join(export, filename), 'w')
+    self.written = 0
+    self.unchanged = 0
+
+  def Write(self, filename, logdata):
+    """ Appends a log to the stream.
+
+    Args:
+      filename: String log filename. Unused, logs identify themselves.
+      logdata: String log content.
+
+    Returns:
+      Boolean True, the log is always written.
+    """
+    if isinstance(logdata, unicode):
+      logdata = logdata.encode('utf8')
+    self._file_pointer.write(logdata)
+    if logdata and not logdata.endswith('\n'):
+      self._file_pointer.write('\n')
+    self.written += 1
+    return True
+
+  def Save(self):
+    """ Flushes the stream; a partially written stream cannot be resumed. """
+    self._file_pointer.flush()
+
+  def Close(self):
+    """ Finishes the stream. """
+    self._file_pointer.close()
+
+
+def NewLogWriter(export, output_format='xml'):
+  """ Returns a log writer for an output format.
+
+  Args:
+    export: String directory to export chat logs to.
+    output_format: String one of FORMATS. Default 'xml'.
+      xml: one .log.xml file per log.
+      gzip: one .log.xml.gz file per log.
+      tar: all logs in logs.tar.
+      tar.gz: all logs in logs.tar.gz.
+      stream: all logs appended to messages.jsonl.
+  """
+  if output_format == 'gzip':
+    return GzipLogWriter(export)
+  if output_format in ('tar', 'tar.gz'):
+    return TarLogWriter(export, compress=output_format == 'tar.gz')
+  if output_format == 'stream':
+    return StreamLogWriter(export)
+  return LogWriter(export)
+
+
+if __name__ == '__main__':
+  pass
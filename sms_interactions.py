@@ -3,8 +3,6 @@
 # Manages all user to user interactions.
 #
 
-import uuid
-
 
 class Interactions(object):
   """ Manages all user to user interactions.
@@ -12,11 +10,21 @@ class Interactions(object):
   An interaction is unique between two users, regardless of who is sending.
 
   A unique UUID is created for each 'interaction' which can be pulled by
-  querying this object with two users in any order.
+  querying this object with two users in any order. The UUID is derived from
+  the most stable identifier of each user (E.164 phone, else email, else
+  name), so the same interaction keeps its UUID across runs, even when a
+  later run learns a name or email for one of the users.
   """
   def __init__(self):
     self._usermap = {}
 
+  def _UserId(self, user):
+    """ Returns the most stable identifier for a User as a UTF-8 String. """
+    user_id = user.E164() or user.email or user.name or ''
+    if isinstance(user_id, unicode):
+      user_id = user_id.encode('utf8')
+    return user_id
+
   def Update(self, user1, user2):
     """ Updates Interactions hashmaps with a new user interactions.
 
@@ -26,7 +34,9 @@ class Interactions(object):
       user1: User object for the first user.
       user2: User object for the second user.
     """
-    interaction_id = uuid.uuid4()
+    import uuid
+    users = '|'.join(sorted((self._UserId(user1), self._UserId(user2))))
+    interaction_id = uuid.uuid5(uuid.NAMESPACE_OID, users)
     self._usermap.setdefault('%s%s' % (user1, user2), interaction_id)
     self._usermap.setdefault('%s%s' % (user2, user1), interaction_id)
 
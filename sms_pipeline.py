@@ -0,0 +1,141 @@
+#!/usr/bin/python
+#
+# Bounded queue stages for overlapping disk I/O and CPU work.
+#
+
+import Queue
+import sys
+import threading
+
+_DONE = object()
+
+
+class _Failure(object):
+  """ Carries an exception raised in a stage thread to the consumer. """
+
+  def __init__(self, exc_info):
+    self.exc_info = exc_info
+
+
+def Map(func, inputs, workers=1, size=64):
+  """ Applies func to inputs in worker threads, yielding results in order.
+
+  At most size items are in flight: an item holds a slot from the moment a
+  worker reads it from inputs until the consumer receives its result. Workers
+  block when the consumer, or one slow item, falls behind. Results are
+  yielded in input order, so the output is the same for any number of
+  workers. An exception raised by func is re-raised in the consumer.
+
+  Args:
+    func: Callable applied to each input item.
+    inputs: Iterable of input items. Only read from one thread at a time.
+    workers: Integer number of worker threads, at least 1. Default 1.
+    size: Integer maximum number of items read but not yet yielded, at least
+        1. Default 64.
+
+  Yields:
+    func(item) for each item in inputs.
+  """
+  assert workers >= 1, 'Map needs at least one worker: %s' % workers
+  assert size >= 1, 'Map needs at least one slot: %s' % size
+  items = enumerate(inputs)
+  lock = threading.Lock()
+  slots = threading.Semaphore(size)
+  results = Queue.Queue()
+  stop = threading.Event()
+
+  def Work():
+    while True:
+      slots.acquire()
+      if stop.is_set():
+        break
+      try:
+        with lock:
+          index, item = next(items)
+      except StopIteration:
+        slots.release()
+        break
+      except Exception:
+        results.put((-1, _Failure(sys.exc_info())))
+        break
+      try:
+        results.put((index, func(item)))
+      except Exception:
+        results.put((index, _Failure(sys.exc_info())))
+        break
+    results.put((None, _DONE))
+
+  threads = [threading.Thread(target=Work) for _ in range(workers)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  pending = {}
+  expected = 0
+  running = workers
+  try:
+    while running:
+      index, result = results.get()
+      if result is _DONE:
+        running -= 1
+        continue
+      if isinstance(result, _Failure):
+        raise result.exc_info[0], result.exc_info[1], result.exc_info[2]
+      pending[index] = result
+      while expected in pending:
+        result = pending.pop(expected)
+        expected += 1
+        slots.release()
+        yield result
+  finally:
+    stop.set()
+    # Wake workers waiting for a slot so they can see stop and exit.
+    for thread in threads:
+      slots.release()
+    for thread in threads:
+      thread.join()
+
+
+def Drain(func, inputs, size=64):
+  """ Calls func on each input in a background thread.
+
+  Inputs are handed over through a bounded queue, so producing inputs (the
+  caller's iteration) overlaps with consuming them and blocks when func falls
+  behind. An exception raised by func is re-raised once inputs stop.
+
+  Args:
+    func: Callable applied to each input item.
+    inputs: Iterable of input items.
+    size: Integer maximum number of items waiting for func. Default 64.
+  """
+  work = Queue.Queue(size)
+  failures = []
+
+  def Work():
+    while True:
+      item = work.get()
+      if item is _DONE:
+        return
+      if failures:
+        continue
+      try:
+        func(item)
+      except Exception:
+        failures.append(sys.exc_info())
+
+  thread = threading.Thread(target=Work)
+  thread.daemon = True
+  thread.start()
+  try:
+    for item in inputs:
+      if failures:
+        break
+      work.put(item)
+  finally:
+    work.put(_DONE)
+    thread.join()
+  if failures:
+    raise failures[0][0], failures[0][1], failures[0][2]
+
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# Quarantine and checkpoint support for long running conversions.
+#
+
+import cPickle
+import hashlib
+import json
+import logging
+import os
+
+
+class Quarantine(object):
+  """ Records SMS emails which could not be converted, instead of aborting.
+
+  Attributes:
+    entries: List of dictionaries {'key': maildir key, 'stage': stage name,
+      'reason': error message} for each quarantined message or user.
+  """
+
+  def __init__(self, location):
+    """ Initialize Quarantine.
+
+    Args:
+      location: String path of the JSON quarantine report.
+    """
+    self._location = location
+    self.entries = []
+
+  def Add(self, key, stage, reason):
+    """ Quarantines a message.
+
+    Args:
+      key: String maildir key of the message, or description of the user.
+      stage: String conversion stage the error happened in.
+      reason: Exception or String reason the message was quarantined.
+    """
+    logging.warning('Quarantined %s during %s: %s', key, stage, reason)
+    self.entries.append({'key': key, 'stage': stage, 'reason': '%s' % reason})
+
+  def Write(self):
+    """ Writes the quarantine report. """
+    file_pointer = open(self._location, 'w')
+    json.dump(self.entries, file_pointer, indent=2, sort_keys=True)
+    file_pointer.close()
+
+
+def MaildirSignature(maildir):
+  """ Returns a String digest identifying the emails in a maildir.
+
+  The digest covers the sorted maildir keys and the mtimes of the cur and new
+  directories, so it changes when emails are added, removed or moved.
+
+  Args:
+    maildir: String location of maildir folder.
+  """
+  digest = hashlib.sha1()
+  keys = []
+  for subdir in ('cur', 'new'):
+    location = os.path.join(maildir, subdir)
+    if not os.path.isdir(location):
+      continue
+    digest.update('%s %r\0' % (subdir, os.path.getmtime(location)))
+    keys.extend(filename.split(':')[0] for filename in os.listdir(location))
+  digest.update('\0'.join(sorted(keys)))
+  return digest.hexdigest()
+
+
+class Checkpoint(object):
+  """ Saves conversion stage results so an interrupted run can resume.
+
+  Each stage result is pickled to .checkpoint-<stage>.pickle in a directory,
+  tagged with a signature of the run options and input, see MaildirSignature.
+  Checkpoints from a run with a different signature are ignored.
+  """
+
+  def __init__(self, directory, signature):
+    """ Initialize Checkpoint.
+
+    Args:
+      directory: String directory to store checkpoints in.
+      signature: Tuple of run options and input the checkpoints are valid
+          for.
+    """
+    self._directory = directory
+    self._signature = signature
+
+  def _Location(self, stage):
+    return os.path.join(self._directory, '.checkpoint-%s.pickle' % stage)
+
+  def Load(self, stage):
+    """ Returns the saved result of a stage, or None if there is none. """
+    location = self._Location(stage)
+    if not os.path.exists(location):
+      return None
+    try:
+      file_pointer = open(location, 'rb')
+      try:
+        signature, data = cPickle.load(file_pointer)
+      finally:
+        file_pointer.close()
+    except (EOFError, cPickle.UnpicklingError), e:
+      logging.warning('Ignoring unreadable checkpoint %s: %s', location, e)
+      return None
+    if signature != self._signature:
+      logging.warning('Ignoring checkpoint from a different run: %s', location)
+      return None
+    print 'Resuming from %s checkpoint ...' % stage
+    return data
+
+  def Save(self, stage, data):
+    """ Saves the result of a stage.
+
+    Args:
+      stage: String stage name.
+      data: Picklable stage result.
+    """
+    location = self._Location(stage)
+    file_pointer = open(location + '.tmp', 'wb')
+    cPickle.dump((self._signature, data), file_pointer,
+                 cPickle.HIGHEST_PROTOCOL)
+    file_pointer.close()
+    os.rename(location + '.tmp', location)
+
+  def Clear(self):
+    """ Removes all checkpoints once a run has completed. """
+    for filename in os.listdir(self._directory):
+      if filename.startswith('.checkpoint-') and filename.endswith('.pickle'):
+        os.remove(os.path.join(self._directory, filename))
+
+
+if __name__ == '__main__':
+  pass
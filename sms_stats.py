@@ -0,0 +1,176 @@
+#!/usr/bin/python
+#
+# Generates message statistics from SMS email headers without a full convert.
+#
+
+import collections
+import csv
+import json
+
+import sms_email
+import sms_users
+
+
+class SmsStats(object):
+  """ Aggregates message counts from SmsMessages in a single pass.
+
+  Counters are keyed by the raw sender/receiver identities while streaming;
+  identities are resolved through sms_users.Users once, per distinct key, when
+  the report is generated.
+
+  Attributes:
+    total: Integer number of messages counted.
+  """
+
+  def __init__(self, top=10, quarantine=None):
+    """ Initialize SmsStats.
+
+    Args:
+      top: Integer number of top senders to report. Default 10.
+      quarantine: sms_recovery.Quarantine to record messages whose users
+          cannot be determined and skip them. Default None (errors are
+          raised).
+    """
+    self._top = top
+    self._quarantine = quarantine
+    self._users = sms_users.Users()
+    self._identities = {}
+    self._pairs = collections.Counter()
+    self._threads = collections.Counter()
+    self._months = collections.Counter()
+    # Counts by maildir key of messages with a user without a phone, which
+    # are removed again if the user is quarantined.
+    self._partial_counts = {}
+    self.total = 0
+
+  def _Identity(self, user, key):
+    """ Returns a String key for a user, tracking the user for resolution.
+
+    Users without a phone are tracked for every message, so the messages can
+    be quarantined if the user conflicts with another user.
+    """
+    identity = str(user)
+    if identity not in self._identities or user.phone is None:
+      self._users.Update(user, key)
+      self._identities[identity] = user
+    return identity
+
+  def _Count(self, counts, count):
+    """ Adds count to the pair, thread and month counters of a message. """
+    pair, thread, month = counts
+    for counter, key in ((self._pairs, pair), (self._threads, thread),
+                         (self._months, month)):
+      counter[key] += count
+      if not counter[key]:
+        del counter[key]
+    self.total += count
+
+  def Update(self, sms):
+    """ Counts a single SmsMessage.
+
+    Args:
+      sms: sms_email.SmsMessage to count. The message body is not used.
+    """
+    try:
+      sender_user = sms.GetSender()
+      receiver_user = sms.GetReceiver()
+      sender = self._Identity(sender_user, sms.key)
+      receiver = self._Identity(receiver_user, sms.key)
+    except (TypeError, sms_users.Error), e:
+      if self._quarantine is None:
+        raise
+      self._quarantine.Add(sms.key, 'users', e)
+      return
+    counts = ((sender, receiver), sms.thread,
+              sms.date.astimezone(sms.tz).strftime('%Y-%m'))
+    self._Count(counts, 1)
+    if sender_user.phone is None or receiver_user.phone is None:
+      self._partial_counts[sms.key] = counts
+
+  def Report(self):
+    """ Resolves identities and returns the aggregated statistics.
+
+    Returns:
+      Dictionary containing counts:
+      {'total': 1234,
+       'contacts': {'user log': 100, ...},
+       'threads': {'thread': 100, ...},
+       'months': {'YYYY-MM': 100, ...},
+       'top_senders': [['user log', 100], ...]}
+    """
+    for key in self._users.ProcessPartialUsers(self._quarantine):
+      counts = self._partial_counts.pop(key, None)
+      if counts is not None:
+        self._Count(counts, -1)
+    resolved = {}
+    for key, user in self._identities.iteritems():
+      try:
+        resolved[key] = self._users.Find(user).Log()
+      except sms_users.Error, e:
+        if self._quarantine is None:
+          raise
+        self._quarantine.Add(key, 'interactions', e)
+        resolved[key] = None
+    contacts = collections.Counter()
+    senders = collections.Counter()
+    for (sender, receiver), count in self._pairs.iteritems():
+      if resolved[sender] is None or resolved[receiver] is None:
+        continue
+      contacts[resolved[sender]] += count
+      if resolved[receiver] != resolved[sender]:
+        contacts[resolved[receiver]] += count
+      senders[resolved[sender]] += count
+    return {
+        'total': self.total,
+        'contacts': dict(contacts),
+        'threads': dict(('%s' % k, v) for k, v in self._threads.iteritems()),
+        'months': dict(self._months),
+        'top_senders': [list(x) for x in senders.most_common(self._top)],
+    }
+
+  def WriteJson(self, file_pointer):
+    """ Writes the statistics report as JSON to an open file. """
+    json.dump(self.Report(), file_pointer, indent=2, sort_keys=True)
+
+  def WriteCsv(self, file_pointer):
+    """ Writes the statistics report as CSV (category, key, count). """
+    report = self.Report()
+    writer = csv.writer(file_pointer)
+    writer.writerow(('category', 'key', 'count'))
+    writer.writerow(('total', '', report['total']))
+    for category in ('contacts', 'threads', 'months'):
+      for key in sorted(report[category]):
+        writer.writerow((category, key, report[category][key]))
+    for key, count in report['top_senders']:
+      writer.writerow(('top_senders', key, count))
+
+
+def LoadStats(maildir, timezone, top=10, quarantine=None, readers=1,
+              parsers=1, queue_size=64):
+  """ Counts SMS messages in a maildir, reading headers only.
+
+  Args:
+    maildir: String location of maildir folder to process.
+    timezone: String timezone to assume messages are received in.
+    top: Integer number of top senders to report. Default 10.
+    quarantine: sms_recovery.Quarantine to record bad emails in and continue.
+        Default None (errors are raised).
+    readers: Integer number of threads reading email files. Default 1.
+    parsers: Integer number of threads parsing emails. Default 1.
+    queue_size: Integer maximum number of emails queued between stages.
+        Default 64.
+
+  Returns:
+    SmsStats object containing the counts for the maildir.
+  """
+  print 'Counting messages ...'
+  stats = SmsStats(top, quarantine)
+  for sms in sms_email.IterMaildir(maildir, timezone, headers_only=True,
+                                   quarantine=quarantine, readers=readers,
+                                   parsers=parsers, queue_size=queue_size):
+    stats.Update(sms)
+  return stats
+
+
+if __name__ == '__main__':
+  pass
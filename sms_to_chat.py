@@ -3,6 +3,8 @@
 # Processes SmsMessagess and converts them to an adium log format.
 #
 
+import collections
+import json
 import logging
 import sys
 
@@ -25,11 +27,24 @@ class Message(object):
     id: Integer SMS message id for ordering.
     thread: Integer SMS message thread for ordering.
     message: String actual SMS message sent.
+    uuid: String interaction UUID for the message.
+    type: Integer SMS message type.
+    read: Integer SMS message status.
+    status: Integer TP-Status.
+    protocol: Integer SMS protocol.
+    service_center: sms_email.LineToken service center message routed though.
+    content_type: String content type for message.
+    key: String maildir key of the email the message came from.
   """
 
-  def __init__(self, to, frome, date, tz, id, message):
+  def __init__(self, to, frome, date, tz, id, message, thread=None, uuid=None,
+               type=None, read=None, status=None, protocol=None,
+               service_center=None, content_type=None, key=None):
     """ Create a basic generic message.
 
+    Only the chat fields (to, frome, date, tz, id, message) identify a message;
+    the remaining SMS details are carried for exporters.
+
     Args:
       to: User object the actual user sending the message.
       frome: User object the actual user recieving the message.
@@ -37,6 +52,15 @@ class Message(object):
       tz: pytz.timezone object representing the timezone of the message.
       id: Integer SMS message id for ordering.
       message: String actual SMS message sent.
+      thread: Integer SMS message thread. Default None.
+      uuid: String interaction UUID for the message. Default None.
+      type: Integer SMS message type. Default None.
+      read: Integer SMS message status. Default None.
+      status: Integer TP-Status. Default None.
+      protocol: Integer SMS protocol. Default None.
+      service_center: sms_email.LineToken service center. Default None.
+      content_type: String content type for message. Default None.
+      key: String maildir key of the email. Default None.
     """
     self.to = to
     self.frome = frome
@@ -44,6 +68,15 @@ class Message(object):
     self.tz = tz
     self.id = id
     self.message = message
+    self.thread = thread
+    self.uuid = uuid
+    self.type = type
+    self.read = read
+    self.status = status
+    self.protocol = protocol
+    self.service_center = service_center
+    self.content_type = content_type
+    self.key = key
 
   def LogDate(self):
     """ Returns the datetime of the message in log format.
@@ -72,7 +105,8 @@ class Message(object):
 
 
 class AdiumLogExporter(object):
-  """ Creates adium XML 0.4 logs for export. """
+  """ Creates adium XML 0.4 logs for export, one log per thread. """
+  BY_INTERACTION = False
   _CHAT_HEADER = '<chat account="%s" service="SMS" version="0.4">'
   _CHAT_OPEN = '  <event type="windowsOpened" time="%s"/>'
   _CHAT_MESSAGE = '  <message sender="%s" time="%s">%s</message>'
@@ -130,6 +164,125 @@ class AdiumLogExporter(object):
       finish_date = messages[0].date
     return (initial_date, finish_date, u'\n'.join(log))
 
+  def LogName(self, convo, thread, start, end):
+    """ Returns the String log filename for a rendered thread. """
+    return ('%s-%s-%s-%s.log.xml' % (convo, thread,
+        start.strftime('%s'), end.strftime('%s')))
+
+
+class JsonLinesExporter(object):
+  """ Creates JSON Lines logs for export, one log per interaction.
+
+  Each line is a JSON object for one message, including the resolved users,
+  UTC and local timestamps and all SMS status fields, e.g.:
+
+  {"content_type": "text/plain", "date_local": "2014-05-13T10:29:20-07:00",
+   "date_utc": "2014-05-13T17:29:20+00:00", "id": 36,
+   "interaction": "a5a13b89-...", "message": "hello", "protocol": 0,
+   "read": 1, "receiver": {"email": ..., "log": ..., "name": ...,
+   "phone": "+12125550000"}, "sender": {...}, "service_center": null,
+   "status": -1, "thread": 5, "type": 2}
+  """
+  BY_INTERACTION = True
+
+  def _User(self, user):
+    """ Returns a Dictionary representing a User, or None. """
+    if user is None or not (user.phone or user.name or user.email):
+      return None
+    return {'phone': user.E164(), 'name': user.name or None,
+            'email': user.email or None, 'log': user.Log()}
+
+  def Convert(self, messages):
+    """ Generates a JSON Lines log.
+
+    Messages are de-duplicated, and sorted by thread then message id.
+
+    Args:
+      messages: List of sms_to_chat.Messages to generate log for.
+
+    Returns:
+      Tuple (initial date, finish date, log)
+    """
+    messages = list(set(messages))
+    messages.sort(key=lambda x: (x.thread, x.id))
+    lines = []
+    for message in messages:
+      service_center = None
+      if message.service_center is not None:
+        service_center = self._User(sms_users.User(
+            message.service_center.phone, message.service_center.name,
+            message.service_center.email))
+      lines.append(json.dumps({
+          'interaction': '%s' % message.uuid,
+          'thread': message.thread,
+          'id': message.id,
+          'sender': self._User(message.frome),
+          'receiver': self._User(message.to),
+          'date_utc': message.date.isoformat(),
+          'date_local': message.LogDate(),
+          'type': message.type,
+          'read': message.read,
+          'status': message.status,
+          'protocol': message.protocol,
+          'service_center': service_center,
+          'content_type': message.content_type,
+          'message': message.message,
+      }, sort_keys=True))
+    dates = [message.date for message in messages]
+    return (min(dates), max(dates), '\n'.join(lines) + '\n')
+
+  def LogName(self, convo, thread, start, end):
+    """ Returns the String log filename for a rendered interaction. """
+    return '%s.jsonl' % convo
+
+
+EXPORTERS = {
+    'adium': AdiumLogExporter,
+    'jsonl': JsonLinesExporter,
+}
+
+
+# Conversations and exporter name being rendered. Published before the worker
+# pool is created so forked workers inherit them, and jobs only carry keys.
+_render_convos = {}
+_render_exporter = 'adium'
+
+
+def _ThreadMessages(convos, convo, thread):
+  """ Returns the List of Messages of a thread.
+
+  Args:
+    convos: Dictionary of Messages indexed by interaction ID, then thread ID.
+    convo: interaction uuid of the thread.
+    thread: Integer thread ID, or None for all threads of the interaction.
+  """
+  if thread is not None:
+    return convos[convo][thread]
+  messages = []
+  for thread in convos[convo]:
+    messages.extend(convos[convo][thread])
+  return messages
+
+
+def _RenderThread(job):
+  """ Renders a single conversation thread to a named log.
+
+  Module level so it can be sent to a multiprocessing worker. Messages are
+  read from _render_convos.
+
+  Args:
+    job: Tuple (index, interaction uuid, thread). thread is None for
+        exporters rendering whole interactions.
+
+  Returns:
+    Tuple (index, log filename, log).
+  """
+  index, convo, thread = job
+  exporter = EXPORTERS[_render_exporter]()
+  start, end, log = exporter.Convert(
+      _ThreadMessages(_render_convos, convo, thread))
+  return (index, exporter.LogName(convo, thread, start, end), log)
+
 
 class SmsToChat(object):
   """ Converts maildir containg SMS-backup-plus emails to an adium chat log.
@@ -140,32 +293,116 @@ class SmsToChat(object):
     users: List of all rich-data user metadata from maildir imports.
     convos: Dictionary of processed sms/email messages, indexed by interaction
       ID, thread ID, then sorted by message ID.
+    workers: Integer number of processes used to render threads.
+    quarantine: sms_recovery.Quarantine recording messages which could not be
+      converted, or None to raise on the first bad message.
+    checkpoint: sms_recovery.Checkpoint saving stage results, or None.
+    queue_size: Integer maximum number of items waiting between stages.
+    exporter: String name of the EXPORTERS entry used to render logs.
   
   """
 
-  def __init__(self, maildir, timezone):
-    self.smss = sms_email.LoadMaildir(maildir, timezone)
+  def __init__(self, maildir, timezone, workers=None, quarantine=None,
+               checkpoint=None, readers=1, parsers=1, queue_size=64,
+               exporter='adium'):
+    """ Initialize SmsToChat.
+
+    Args:
+      maildir: String location of maildir folder to process.
+      timezone: String timezone to assume messages are received in.
+      workers: Integer number of processes used to render threads. Default
+          None (one per CPU).
+      quarantine: sms_recovery.Quarantine to record bad messages in and
+          continue. Default None (errors are raised).
+      checkpoint: sms_recovery.Checkpoint to save and resume stage results
+          with. Default None.
+      readers: Integer number of threads reading email files. Default 1.
+      parsers: Integer number of threads parsing emails. Default 1.
+      queue_size: Integer maximum number of items waiting between stages.
+          Default 64.
+      exporter: String name of the EXPORTERS entry used to render logs.
+          Default 'adium'.
+    """
+    if not workers:
+      import multiprocessing
+      workers = multiprocessing.cpu_count()
+    self.workers = workers
+    self.quarantine = quarantine
+    self.checkpoint = checkpoint
+    self.queue_size = queue_size
+    self.exporter = exporter
     self.interactions = sms_interactions.Interactions()
     self.users = sms_users.Users()
-    self.convos = {}
-    self.log_exporter = AdiumLogExporter()
+    self.convos = self._LoadStage('index') or {}
+    if self.convos:
+      self.smss = []
+    else:
+      self.smss = self._LoadStage('load')
+      if self.smss is None:
+        self.smss = sms_email.LoadMaildir(
+            maildir, timezone, quarantine, readers, parsers, queue_size)
+        self._SaveStage('load', self.smss)
+
+  def _LoadStage(self, stage):
+    """ Returns the checkpointed result of a stage, or None.
+
+    Quarantined messages recorded up to that stage are restored.
+    """
+    if self.checkpoint is None:
+      return None
+    state = self.checkpoint.Load(stage)
+    if state is None:
+      return None
+    data, entries = state
+    if self.quarantine is not None:
+      self.quarantine.entries = entries
+    return data
+
+  def _SaveStage(self, stage, data):
+    """ Checkpoints the result of a stage with the quarantine so far. """
+    if self.quarantine is not None:
+      self.quarantine.Write()
+    if self.checkpoint is not None:
+      entries = self.quarantine.entries if self.quarantine else []
+      self.checkpoint.Save(stage, (data, entries))
 
   def _IndexUsers(self):
     """ Indexes Users from SMS messages.
     
     This generates a complete 'user' picture per user, then
     creates UUID's for each specific user/user interaction.
+
+    Messages whose users cannot be determined are quarantined and removed
+    from smss when a quarantine is set.
     """
     print 'Indexing user metadata ...'
+    smss = []
     for mail in self.smss:
-      self.users.Update(mail.GetSender())
-      self.users.Update(mail.GetReceiver())
-    self.users.ProcessPartialUsers()
-    for mail in self.smss:
-      user1 = self.users.Find(mail.GetSender())
-      user2 = self.users.Find(mail.GetReceiver())
+      try:
+        self.users.Update(mail.GetSender(), mail.key)
+        self.users.Update(mail.GetReceiver(), mail.key)
+      except (TypeError, sms_users.Error), e:
+        if self.quarantine is None:
+          raise
+        self.quarantine.Add(mail.key, 'users', e)
+        continue
+      smss.append(mail)
+    quarantined = self.users.ProcessPartialUsers(self.quarantine)
+    self.smss = []
+    for mail in smss:
+      if mail.key in quarantined:
+        continue
+      try:
+        user1 = self.users.Find(mail.GetSender())
+        user2 = self.users.Find(mail.GetReceiver())
+      except sms_users.Error, e:
+        if self.quarantine is None:
+          raise
+        self.quarantine.Add(mail.key, 'interactions', e)
+        continue
       self.interactions.Update(user1, user2)
       mail.uuid = self.interactions.Get(user1, user2)
+      self.smss.append(mail)
 
   def _IndexMessages(self):
     """ Indexes SmsMessages into conversations for export.
@@ -186,23 +423,113 @@ class SmsToChat(object):
       from_user = self.users.Find(mail.GetSender())
       to_user = self.users.Find(mail.GetReceiver())
       sms = Message(to_user, from_user, mail.date,
-                    mail.tz, mail.id, mail.message)
+                    mail.tz, mail.id, mail.message, thread=mail.thread,
+                    uuid=mail.uuid, type=mail.type, read=mail.read,
+                    status=mail.status, protocol=mail.protocol,
+                    service_center=mail.service_center,
+                    content_type=mail.content_type, key=mail.key)
       self.convos.setdefault(mail.uuid, {})
       self.convos[mail.uuid].setdefault(mail.thread, [])
       self.convos[mail.uuid][mail.thread].append(sms)
 
   def Process(self):
-    self._IndexMessages()
+    """ Renders every conversation thread to a log.
+
+    Returns:
+      List of tuples (log filename, log), see IterLogs.
+    """
+    return list(self.IterLogs())
+
+  def IterLogs(self):
+    """ Yields logs for every conversation thread as they are rendered.
+
+    Threads are rendered in a worker pool, largest first, so a single large
+    conversation does not hold up the end of the run. At most queue_size
+    rendered logs wait to be consumed, so writing them overlaps rendering.
+    Logs are yielded in the same order regardless of the number of workers.
+
+    With a checkpoint, the indexed conversations are saved so an interrupted
+    run resumes from rendering; the writer manifest skips logs already
+    written.
+
+    Yields:
+      Tuples (log filename, log).
+    """
+    if not self.convos:
+      self._IndexMessages()
+      self._SaveStage('index', self.convos)
+    for chat_log in self._Render():
+      yield chat_log
+
+  def _Render(self):
+    """ Renders all indexed threads, yielding (log filename, log) tuples.
+
+    Threads which fail to render are skipped and their messages quarantined
+    when a quarantine is set.
+    """
+    global _render_convos, _render_exporter
     print 'Processing messages ...'
-    chat_logs = []
+    jobs = []
     for convo in self.convos:
+      if EXPORTERS[self.exporter].BY_INTERACTION:
+        jobs.append((len(jobs), convo, None))
+        continue
       for thread in self.convos[convo]:
-        start, end, log = self.log_exporter.Convert(self.convos[convo][thread])
-        logname = ('%s-%s-%s-%s.log.xml' % (convo, thread,
-            start.strftime('%s'), end.strftime('%s')))
-        chat_logs.append((logname, log))
-    return chat_logs
+        jobs.append((len(jobs), convo, thread))
+    jobs.sort(key=lambda x: len(_ThreadMessages(self.convos, x[1], x[2])),
+              reverse=True)
+    _render_convos = self.convos
+    _render_exporter = self.exporter
+    try:
+      if self.workers > 1 and len(jobs) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(self.workers)
+        try:
+          pending = collections.deque()
+          for job in jobs:
+            pending.append((job, pool.apply_async(_RenderThread, (job,))))
+            if len(pending) >= max(self.queue_size, self.workers):
+              job, result = pending.popleft()
+              chat_log = self._Collect(job, result.get)
+              if chat_log is not None:
+                yield chat_log
+          while pending:
+            job, result = pending.popleft()
+            chat_log = self._Collect(job, result.get)
+            if chat_log is not None:
+              yield chat_log
+        finally:
+          pool.terminate()
+          pool.join()
+      else:
+        for job in jobs:
+          chat_log = self._Collect(job, lambda: _RenderThread(job))
+          if chat_log is not None:
+            yield chat_log
+    finally:
+      _render_convos = {}
+
+  def _Collect(self, job, render):
+    """ Returns the (log filename, log) rendered for a job.
+
+    Args:
+      job: Tuple job passed to _RenderThread.
+      render: Callable returning the _RenderThread result for the job.
 
+    Returns:
+      Tuple (log filename, log), or None if rendering failed and the
+      messages of the job were quarantined.
+    """
+    try:
+      _, logname, log = render()
+    except Exception, e:
+      if self.quarantine is None:
+        raise
+      _, convo, thread = job
+      for message in _ThreadMessages(self.convos, convo, thread):
+        self.quarantine.Add(message.key, 'render', e)
+      return None
+    return (logname, log)
 
 if __name__ == '__main__':
   pass
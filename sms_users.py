@@ -2,12 +2,20 @@
 #
 # Manages users for SMS email message imports.
 #
+# phonenumbers is imported on first use; it is the slowest import at startup
+# and is not needed for --help or runs which never parse a number.
+#
 
 import logging
-import phonenumbers
+import re
+
+# Common header shapes which are classified without libphonenumber.
+_SEPARATORS = re.compile(r'[ ().-]')
+_US_NUMBER = re.compile(r'^(?:\+?1)?([2-9][0-9]{9})$')
+_PLAIN_EMAIL = re.compile(r'^[A-Za-z._%-]+@[A-Za-z-]+(?:\.[A-Za-z-]+)+$')
 
-E164 = phonenumbers.PhoneNumberFormat.E164
-INTERNATIONAL = phonenumbers.PhoneNumberFormat.INTERNATIONAL
+# Region numbers without a country code are parsed in.
+_region = 'US'
 
 
 class Error(Exception):
@@ -15,13 +23,78 @@ class Error(Exception):
   pass
 
 
+def SetRegion(region):
+  """ Sets the region numbers without a country code are parsed in.
+
+  phonenumbers loads metadata per region on first use, so only the metadata
+  for this region (and any country codes actually seen) is loaded.
+
+  Args:
+    region: String two letter region code, e.g. 'US'.
+
+  Raises:
+    Error: If the region is not supported by phonenumbers.
+  """
+  global _region
+  region = region.upper()
+  if region == _region:
+    return
+  import phonenumbers
+  if region not in phonenumbers.SUPPORTED_REGIONS:
+    raise Error('Unsupported phone number region: %s' % region)
+  _region = region
+
+
+def GetRegion():
+  """ Returns the String region set with SetRegion. """
+  return _region
+
+
+def IsPlainEmail(data):
+  """ Returns True if data is an obvious email address.
+
+  Only addresses without digits or '+' are matched, as phonenumbers.parse may
+  extract a phone number from those.
+
+  Args:
+    data: String to classify.
+  """
+  return _PLAIN_EMAIL.match(data) is not None
+
+
+def ParsePhone(data):
+  """ Parses a String as a phone number in the configured region.
+
+  When the region is US, plain 10 or 11 digit US numbers and +1 E.164 numbers
+  (optionally with spaces, dashes, dots or parentheses) are built directly.
+  Anything else is parsed with phonenumbers.parse(data, region).
+
+  Args:
+    data: String phone number.
+
+  Returns:
+    phonenumbers.phonenumber.PhoneNumber object.
+
+  Raises:
+    phonenumbers.NumberParseException: If data is not a phone number.
+  """
+  import phonenumbers
+  if _region == 'US':
+    match = _US_NUMBER.match(_SEPARATORS.sub('', data))
+    if match:
+      return phonenumbers.PhoneNumber(
+          country_code=1, national_number=long(match.group(1)))
+  return phonenumbers.parse(data, _region)
+
+
 class User(object):
   """ A SMS user.
 
   Attributes:
     name: String user's real name.
     email: String user's email address.
-    phone: phonenumber.phonenumbers.PhoneNumber object. Assumes US format.
+    phone: phonenumber.phonenumbers.PhoneNumber object. Assumes the region
+        set with SetRegion (US by default).
   """
 
   def __init__(self, phone=None, name=None, email=None):
@@ -29,14 +102,15 @@ class User(object):
 
     Args:
       phone: String or phonenumbers object containing phone number. String is
-          parsed as a US phone number.
+          parsed with ParsePhone.
       name: String user name.
       email: String user email.
     """
-    if isinstance(phone, phonenumbers.phonenumber.PhoneNumber):
+    import phonenumbers
+    if isinstance(phone, phonenumbers.PhoneNumber):
       self.phone = phone
     elif phone is not None:
-      self.phone = phonenumbers.parse(phone, "US")
+      self.phone = ParsePhone(phone)
     else:
       self.phone = None
     self.name = name
@@ -87,8 +161,10 @@ class User(object):
       String chat log representation of the user:
       +X XXX-XXX-XXXX 'Full Name' (email)
     """
+    import phonenumbers
     if self.phone:
-      phone = phonenumbers.format_number(self.phone, INTERNATIONAL)
+      phone = phonenumbers.format_number(
+          self.phone, phonenumbers.PhoneNumberFormat.INTERNATIONAL)
     else:
       phone = ''
     if self.name:
@@ -101,12 +177,16 @@ class User(object):
       email = ''
     return ' '.join(('%s %s %s' % (phone, name, email)).split())
 
-  def __str__(self):
+  def E164(self):
+    """ Returns the String E.164 phone number of the user, or None. """
+    import phonenumbers
     if self.phone:
-      phone = phonenumbers.format_number(self.phone, E164)
-    else:
-      phone = None
-    return '%s:%s:%s' % (phone, self.name, self.email)
+      return phonenumbers.format_number(
+          self.phone, phonenumbers.PhoneNumberFormat.E164)
+    return None
+
+  def __str__(self):
+    return '%s:%s:%s' % (self.E164(), self.name, self.email)
 
   def __repr__(self):
     return 'User(%s, %s, %s)' % (self.phone, self.name, self.email)
@@ -117,6 +197,7 @@ class Users(object):
 
   def __init__(self):
     self._users = []
+    # Tuples (User, List of maildir keys of the messages it came from).
     self._partial_users = []
 
   def _UpdateName(self, user, name):
@@ -161,7 +242,7 @@ class Users(object):
       logging.critical('User has two phones! %s %s', user, phone)
       raise Error('User has two phones! %s %s' % (user, phone)) 
 
-  def ProcessPartialUsers(self):
+  def ProcessPartialUsers(self, quarantine=None):
     """ Updates or adds a user to the list of Users.
 
     On update, all users are scanned for duplicate values, and modifications
@@ -175,32 +256,62 @@ class Users(object):
     or email addresses.
 
     Any user without a 'phone' is then added to the user list.
+
+    Args:
+      quarantine: sms_recovery.Quarantine to record the messages of partial
+          users which conflict with existing users, and skip those users.
+          Default None (Error is raised).
+
+    Returns:
+      Set of String maildir keys of the messages quarantined. These must not
+      be looked up with Find, as they would match the conflicting user.
     """
-    for partial_user in self._partial_users:
-      for user in self._users:
-        if user.phone == partial_user.phone and user.phone is not None:
-          self._UpdateName(user, partial_user.name)
-          self._UpdateEmail(user, partial_user.email)
-          logging.critical('Partial user match on phone: %s / %s',
-                          partial_user, user)
-          continue
-        if user.email == partial_user.email and user.email is not None:
-          self._UpdatePhone(user, partial_user.phone)
-          self._UpdateName(user, partial_user.name)
-          logging.critical('Partial user match on email: %s / %s',
-                          partial_user, user)
-          continue
-        if user.name == partial_user.name and user.name is not None:
-          self._UpdatePhone(user, partial_user.phone)
-          self._UpdateEmail(user, partial_user.email)
-          logging.critical('Partial user match on name: %s / %s',
-                          partial_user, user)
-          continue
+    quarantined = set()
+    for partial_user, keys in self._partial_users:
+      try:
+        self._MergePartialUser(partial_user)
+      except Error, e:
+        if quarantine is None:
+          raise
+        for key in sorted(set(keys)):
+          quarantine.Add(key, 'users', e)
+        quarantined.update(keys)
+        continue
       self._users.append(partial_user)
       logging.warning('Partial user added to users: %s', partial_user)
     self._partial_users = []
+    return quarantined
 
-  def Update(self, new_user):
+  def _MergePartialUser(self, partial_user):
+    """ Merges a partial user's information into matching users.
+
+    Args:
+      partial_user: User object without a phone.
+
+    Raises:
+      Error: If the partial user conflicts with a matching user.
+    """
+    for user in self._users:
+      if user.phone == partial_user.phone and user.phone is not None:
+        self._UpdateName(user, partial_user.name)
+        self._UpdateEmail(user, partial_user.email)
+        logging.critical('Partial user match on phone: %s / %s',
+                        partial_user, user)
+        continue
+      if user.email == partial_user.email and user.email is not None:
+        self._UpdatePhone(user, partial_user.phone)
+        self._UpdateName(user, partial_user.name)
+        logging.critical('Partial user match on email: %s / %s',
+                        partial_user, user)
+        continue
+      if user.name == partial_user.name and user.name is not None:
+        self._UpdatePhone(user, partial_user.phone)
+        self._UpdateEmail(user, partial_user.email)
+        logging.critical('Partial user match on name: %s / %s',
+                        partial_user, user)
+        continue
+
+  def Update(self, new_user, key=None):
     """ Updates or adds a user to the list of Users.
 
     Users are added if they have a phone. If they don't have a phone, they
@@ -212,14 +323,19 @@ class Users(object):
 
     Args:
       new_user: User object containing information to update.
+      key: String maildir key of the message the user came from. Recorded for
+          partial users, see ProcessPartialUsers. Default None.
     """
     if new_user.phone is None:
-      for user in self._partial_users:
+      for user, keys in self._partial_users:
         if (user.phone == new_user.phone and
             user.name == new_user.name and
             user.email == new_user.email):
+          if key is not None:
+            keys.append(key)
           return
-      self._partial_users.append(new_user)
+      self._partial_users.append(
+          (new_user, [key] if key is not None else []))
       return
     for user in self._users:
       if user.phone == new_user.phone and user.phone is not None:
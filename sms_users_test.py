@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Tests for sms_users.
+#
+# ParsePhone and LineToken must give the same results as parsing every value
+# with phonenumbers.parse(data, 'US').
+#
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import phonenumbers
+
+import sms_email
+import sms_recovery
+import sms_users
+
+
+def ReferenceParse(raw_data):
+  """ LineToken parsing without the fast path, as it was before it. """
+  data = raw_data.strip()
+  if '@unknown.person' in raw_data:
+    data = data.rsplit('@', 1)[0]
+  if 'SMS with ' in raw_data:
+    data = data.split('SMS with ')[1].strip()
+  try:
+    return (phonenumbers.parse(data, 'US'), None, None)
+  except Exception:
+    if '@' in data:
+      if '<' in data and '>' in data:
+        name_mail = data.split('<')
+        return (None, name_mail[0].strip('" '), name_mail[1].strip('<> '))
+      else:
+        return (None, None, data)
+    else:
+      return (None, data, None)
+
+
+CASES = [
+    # Plain, 11 digit and E.164 US numbers.
+    '2125550000', '12125550000', '+12125550000', '  2125550000  ',
+    # Separators.
+    '212-555-0000', '212.555.0000', '212 555 0000', '(212) 555-0000',
+    '1 (212) 555-0000', '+1 212 555 0000', '+1-212-555-0000', '(212 555-0000',
+    # Shapes the fast path must leave to libphonenumber.
+    '+11234567890', '11234567890', '1212555000', '0212555000',
+    '1-800-FLOWERS', '+442071234567', '+2125550000', '911', '12345',
+    '2125550000 ext. 12',
+    # Emails and names.
+    'bob@example.com', 'bob.smith@mail.example.com', 'bob123@example.com',
+    'bob+sms@example.com', '"Bob Smith" <bob@example.com>', 'Bob Smith',
+    '', 'null',
+    # SMS Backup+ specific forms.
+    'SMS with 2125550000', 'SMS with Bob Smith', '2125550000@unknown.person',
+    'bob@example.com@unknown.person',
+]
+
+
+class ParsePhoneTest(unittest.TestCase):
+
+  def setUp(self):
+    sms_users.SetRegion('US')
+
+  def assertParseEqual(self, data):
+    try:
+      expected = phonenumbers.parse(data, 'US')
+    except phonenumbers.NumberParseException:
+      self.assertRaises(
+          phonenumbers.NumberParseException, sms_users.ParsePhone, data)
+      return
+    self.assertEqual(expected, sms_users.ParsePhone(data), repr(data))
+
+  def testCases(self):
+    for data in CASES:
+      self.assertParseEqual(data.strip())
+
+  def testGenerated(self):
+    generator = random.Random(0)
+    for _ in range(20000):
+      data = ''.join(generator.choice('0123456789+-() .1')
+                     for _ in range(generator.randint(1, 16)))
+      self.assertParseEqual(data)
+
+  def testFastPathRejects(self):
+    for data in ('+11234567890', '1212555000', '1-800-FLOWERS', '+2125550000',
+                 '0212555000'):
+      self.assertEqual(
+          None, sms_users._US_NUMBER.match(sms_users._SEPARATORS.sub('', data)),
+          data)
+
+  def testIsPlainEmail(self):
+    self.assertTrue(sms_users.IsPlainEmail('bob@example.com'))
+    self.assertFalse(sms_users.IsPlainEmail('bob123@example.com'))
+    self.assertFalse(sms_users.IsPlainEmail('bob+sms@example.com'))
+    self.assertFalse(sms_users.IsPlainEmail('"Bob" <bob@example.com>'))
+
+  def testUser(self):
+    for data in CASES:
+      try:
+        expected = phonenumbers.parse(data, 'US')
+      except phonenumbers.NumberParseException:
+        continue
+      self.assertEqual(expected, sms_users.User(data).phone, repr(data))
+
+
+class LineTokenTest(unittest.TestCase):
+
+  def setUp(self):
+    sms_users.SetRegion('US')
+
+  def assertTokenEqual(self, data):
+    token = sms_email.LineToken(data)
+    self.assertEqual(ReferenceParse(data),
+                     (token.phone, token.name, token.email), repr(data))
+
+  def testCases(self):
+    for data in CASES:
+      self.assertTokenEqual(data)
+
+  def testGenerated(self):
+    generator = random.Random(1)
+    for _ in range(20000):
+      data = ''.join(generator.choice('0123456789+-() .1@ab<>"')
+                     for _ in range(generator.randint(1, 20)))
+      self.assertTokenEqual(data)
+
+
+class UsersTest(unittest.TestCase):
+
+  def setUp(self):
+    sms_users.SetRegion('US')
+    self.directory = tempfile.mkdtemp()
+    self.quarantine = sms_recovery.Quarantine(
+        os.path.join(self.directory, 'quarantine.json'))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testConflictingPartialUserQuarantinesMessages(self):
+    users = sms_users.Users()
+    users.Update(sms_users.User('2125550000', 'Bob', 'bob@example.com'), 'a')
+    users.Update(sms_users.User(None, 'Other', 'bob@example.com'), 'b')
+    users.Update(sms_users.User(None, 'Other', 'bob@example.com'), 'c')
+    users.Update(sms_users.User(None, 'Me', 'me@example.com'), 'd')
+    self.assertEqual(set(['b', 'c']),
+                     users.ProcessPartialUsers(self.quarantine))
+    self.assertEqual([('b', 'users'), ('c', 'users')],
+                     [(e['key'], e['stage']) for e in self.quarantine.entries])
+    self.assertEqual(
+        'Me', users.Find(sms_users.User(None, None, 'me@example.com')).name)
+
+  def testConflictingPartialUserRaises(self):
+    users = sms_users.Users()
+    users.Update(sms_users.User('2125550000', 'Bob', 'bob@example.com'), 'a')
+    users.Update(sms_users.User(None, 'Other', 'bob@example.com'), 'b')
+    self.assertRaises(sms_users.Error, users.ProcessPartialUsers)
+
+
+if __name__ == '__main__':
+  unittest.main()